@@ -1,11 +1,27 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+import orjson
 from dotenv import load_dotenv
 load_dotenv()
 import os
-from gemini_utils import process_user_message, format_response
+from concurrent.futures import ThreadPoolExecutor
+from gemini_utils import process_user_message, stream_user_message, format_response, get_cache_stats
 
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+MAX_BATCH_MESSAGES = 20
+BATCH_WORKERS = 4  # Bounds concurrent LLM calls per batch request
 
 @app.route('/', methods=['GET'])
 def index():
@@ -39,5 +55,54 @@ def cultura():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/cultura/stream', methods=['POST'])
+def cultura_stream():
+    data = request.get_json()
+    user_msg = data.get('message', '')
+    if not user_msg:
+        return jsonify({'error': 'No message provided'}), 400
+    user_id = 'web_user'  # In production, use real user/session ID
+
+    def generate():
+        try:
+            for token in stream_user_message(user_msg, user_id):
+                yield f"data: {app.json.dumps({'token': token})}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {app.json.dumps({'error': str(e)})}\n\n"
+        yield "event: done\ndata: {}\n\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/cultura/batch', methods=['POST'])
+def cultura_batch():
+    data = request.get_json()
+    messages = data.get('messages', [])
+    if not messages or not isinstance(messages, list) or not all(isinstance(m, str) and m for m in messages):
+        return jsonify({'error': 'messages must be a non-empty list of strings'}), 400
+    if len(messages) > MAX_BATCH_MESSAGES:
+        return jsonify({'error': f'At most {MAX_BATCH_MESSAGES} messages per batch'}), 400
+    client_user_id = data.get('user_id')
+    if client_user_id is not None and (not isinstance(client_user_id, str) or not client_user_id):
+        return jsonify({'error': 'user_id must be a non-empty string'}), 400
+    try:
+        # Namespaced so web clients can't address Telegram users' profiles
+        user_id = f"web:{client_user_id}" if client_user_id else 'web_user'
+        # Duplicate messages share one reply, so only process each once
+        unique_messages = list(dict.fromkeys(messages))
+        # Profile updates are per-field HSETs, so parallel messages don't drop each other's fields
+        with ThreadPoolExecutor(max_workers=min(BATCH_WORKERS, len(unique_messages))) as executor:
+            replies = list(executor.map(lambda m: process_user_message(m, user_id), unique_messages))
+        return jsonify({msg: format_response(reply) for msg, reply in zip(unique_messages, replies)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(get_cache_stats())
+
 if __name__ == '__main__':
     app.run(debug=True) 
\ No newline at end of file
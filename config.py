@@ -1,4 +1,8 @@
 import os
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -15,6 +19,13 @@ GEMINI_MODELS = [
 # Environment variables
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 GEMINI_MODEL = os.getenv('GEMINI_MODEL', GEMINI_MODELS[0])  # Default to 1.5-flash
+GEMINI_TRANSPORT = os.getenv('GEMINI_TRANSPORT')  # 'rest' under gevent, default gRPC otherwise
+LLM_CACHE_ENABLED = os.getenv('CULTURA_LLM_CACHE') == '1'  # Cache LLM responses in-process
+GEO_CACHE_DIR = os.getenv('CULTURA_GEO_CACHE_DIR', '/tmp/cultura_geo')  # On-disk geocode cache
+LOCATION_CACHE_DIR = os.getenv('CULTURA_LOCATION_CACHE_DIR', '/tmp/cultura_location')  # On-disk location classification cache
+GAZETTEER_PATH = os.getenv('CULTURA_GAZETTEER_PATH')  # GeoNames cities file for location matching; regex fallback when unset
+REDIS_URL = os.getenv('REDIS_URL')  # Shared user preference store; in-process dict when unset
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
 
 def get_gemini_config():
     """
@@ -27,4 +38,27 @@ def get_gemini_config():
         'api_key': GEMINI_API_KEY,
         'model': GEMINI_MODEL,
         'available_models': GEMINI_MODELS
-    }
\ No newline at end of file
+    }
+
+_log_listener = None
+
+def configure_logging(logger_name='location'):
+    """
+    Route one module's log records through a queue so handler I/O runs on a
+    background thread instead of the request path. Safe to call more than once.
+    The root logger is left alone: at INFO, httpx logs request URLs, and the
+    Telegram API URLs contain the bot token.
+    """
+    global _log_listener
+    if _log_listener is not None:
+        return
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    logger = logging.getLogger(logger_name)
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    _log_listener = QueueListener(log_queue, handler)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
\ No newline at end of file
@@ -1,146 +1,623 @@
 from dotenv import load_dotenv
 load_dotenv()
 import os
-import google.generativeai as genai
 import re
-import random
+import json
+import hashlib
+import threading
+import time
+import asyncio
+from typing import TypedDict
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from cachetools import TTLCache
 
 # Import enhanced config
-from config import get_gemini_config
-# Import your location API
-from geo import LocationAPI
+from config import get_gemini_config, GEMINI_TRANSPORT, LLM_CACHE_ENABLED
+from user_store import UserPreferenceStore, get_redis_client
+
+# Models tried in order when the preferred model for a task fails
+FALLBACK_CHAIN = ['models/gemini-1.5-flash-8b', 'models/gemini-1.5-flash', 'models/gemini-2.0-flash']
 
 # Simple task-to-model mapping
+# Fixed-schema JSON tasks (e.g. location classification) run on the small model in JSON mode
+STRUCTURED_JSON_GENERATION_CONFIG = {'response_mime_type': 'application/json'}
+
 def get_model_for_task(task_complexity):
-    if task_complexity == 'simple':
-        return 'models/gemini-1.5-flash'
-    elif task_complexity == 'medium':
-        return 'models/gemini-2.0-flash'
+    if task_complexity in ('simple', 'structured_json'):
+        return 'models/gemini-1.5-flash-8b'
     else:
-        return 'models/gemini-2.5-flash'
+        return 'models/gemini-2.0-flash'
+
+def _models_for_task(task_complexity):
+    """Preferred model for the task followed by the rest of the fallback chain"""
+    model_name = get_model_for_task(task_complexity)
+    return [model_name] + [m for m in FALLBACK_CHAIN if m != model_name]
+
+# google.generativeai pulls in a large gRPC/protobuf stack, so it is imported
+# and configured on first use to keep worker start-up and GET / fast
+genai = None
+_genai_lock = threading.Lock()
+
+def _get_genai():
+    """Import and configure the Gemini SDK on first use"""
+    global genai
+    if genai is None:
+        with _genai_lock:
+            if genai is None:
+                import google.generativeai as sdk
+                try:
+                    gemini_config = get_gemini_config()  # No args now
+                    sdk.configure(api_key=gemini_config['api_key'], transport=GEMINI_TRANSPORT)
+                    print(f"Using model: {gemini_config['model']}")
+                except Exception as e:
+                    print(f"Configuration error: {e}")
+                    sdk.configure(api_key=os.getenv('GEMINI_API_KEY'), transport=GEMINI_TRANSPORT)
+                genai = sdk
+    return genai
+
+# User preference storage, shared across workers via Redis when REDIS_URL is set
+user_preferences = UserPreferenceStore(get_redis_client())
 
-# Configure Gemini API
-try:
-    gemini_config = get_gemini_config()  # No args now
-    genai.configure(api_key=gemini_config['api_key'])
-    print(f"Using model: {gemini_config['model']}")
-except Exception as e:
-    print(f"Configuration error: {e}")
-    genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
+# Location API, created on first use
+_location_api = None
 
-# User preference storage (in production, use a database)
-user_preferences = {}
+def _get_location_api():
+    global _location_api
+    if _location_api is None:
+        from geo import LocationAPI
+        _location_api = LocationAPI()
+    return _location_api
 
-# Initialize location API
-location_api = LocationAPI()
+def set_location_http_client(client):
+    """Route async geocoding through a shared httpx.AsyncClient owned by the caller"""
+    _get_location_api().async_client = client
+
+class LLMCache:
+    """In-process TTL cache for LLM responses keyed by model, prompt and task"""
+
+    def __init__(self, maxsize=4096, ttl=3600):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()  # TTLCache is not thread-safe
+        self.stats = {'hits': 0, 'misses': 0}
+
+    @staticmethod
+    def make_key(model_name, prompt, task_complexity):
+        payload = json.dumps({'model': model_name, 'prompt': prompt, 'task': task_complexity}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            value = self._cache.get(key)
+            if value is None:
+                self.stats['misses'] += 1
+            else:
+                self.stats['hits'] += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._cache[key] = value
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                **self.stats,
+                'size': len(self._cache),
+                'maxsize': self._cache.maxsize,
+                'ttl': self._cache.ttl
+            }
 
-def _llm_chat(prompt, task_complexity='medium', use_random_model=True):
+# LLM response cache (enable with CULTURA_LLM_CACHE=1)
+llm_cache = LLMCache() if LLM_CACHE_ENABLED else None
+
+def get_cache_stats():
+    """Return LLM cache hit/miss statistics"""
+    if llm_cache is None:
+        return {'enabled': False}
+    return {'enabled': True, **llm_cache.get_stats()}
+
+def _log_cached_tokens(response):
+    """Log how many prompt tokens Gemini served from its prompt cache"""
+    usage = getattr(response, 'usage_metadata', None)
+    cached_tokens = getattr(usage, 'cached_content_token_count', 0) if usage else 0
+    if cached_tokens:
+        print(f"Prompt cache hit: {cached_tokens} cached tokens")
+
+LLM_ERROR_REPLY = "I'm having trouble generating a response right now. Please try again."
+
+# One GenerativeModel per model name, reused across calls
+_MODEL_INSTANCES = {}
+
+def _get_model(model_name):
+    model = _MODEL_INSTANCES.get(model_name)
+    if model is None:
+        model = _MODEL_INSTANCES.setdefault(model_name, _get_genai().GenerativeModel(model_name))
+    return model
+
+def _lookup_cached_response(model_name, prompt, task_complexity):
+    """Return (cache_key, cached_text); both are None when caching is disabled"""
+    if llm_cache is None:
+        return None, None
+    cache_key = LLMCache.make_key(model_name, prompt, task_complexity)
+    return cache_key, llm_cache.get(cache_key)
+
+def _llm_chat(prompt, task_complexity='medium', generation_config=None):
     """Enhanced LLM chat with model selection"""
+    if generation_config is None and task_complexity == 'structured_json':
+        generation_config = STRUCTURED_JSON_GENERATION_CONFIG
+    models = _models_for_task(task_complexity)
+    cache_key, cached = _lookup_cached_response(models[0], prompt, task_complexity)
+    if cached is not None:
+        return cached
+    for model_name in models:
+        try:
+            print(f"Using model: {model_name}")
+            model = _get_model(model_name)
+            response = model.generate_content(prompt, generation_config=generation_config)
+            _log_cached_tokens(response)
+            text = response.text.strip()
+            track_model_performance(model_name, success=True)
+            if cache_key is not None:
+                llm_cache.set(cache_key, text)
+            return text
+        except Exception as e:
+            print(f"LLM Error with {model_name}: {str(e)}")
+            track_model_performance(model_name, success=False)
+    return LLM_ERROR_REPLY
+
+async def _llm_chat_async(prompt, task_complexity='medium', generation_config=None):
+    """Async variant of _llm_chat"""
+    if generation_config is None and task_complexity == 'structured_json':
+        generation_config = STRUCTURED_JSON_GENERATION_CONFIG
+    models = _models_for_task(task_complexity)
+    cache_key, cached = _lookup_cached_response(models[0], prompt, task_complexity)
+    if cached is not None:
+        return cached
+    for model_name in models:
+        try:
+            print(f"Using model: {model_name}")
+            model = _get_model(model_name)
+            response = await model.generate_content_async(prompt, generation_config=generation_config)
+            _log_cached_tokens(response)
+            text = response.text.strip()
+            track_model_performance(model_name, success=True)
+            if cache_key is not None:
+                llm_cache.set(cache_key, text)
+            return text
+        except Exception as e:
+            print(f"LLM Error with {model_name}: {str(e)}")
+            track_model_performance(model_name, success=False)
+    return LLM_ERROR_REPLY
+
+def _llm_chat_stream(prompt, task_complexity='medium'):
+    """Streaming variant of _llm_chat that yields text chunks as they arrive"""
+    for model_name in _models_for_task(task_complexity):
+        started = False
+        try:
+            print(f"Using model: {model_name}")
+            model = _get_model(model_name)
+            for chunk in model.generate_content(prompt, stream=True):
+                if chunk.text:
+                    started = True
+                    yield chunk.text
+            track_model_performance(model_name, success=True)
+            return
+        except Exception as e:
+            print(f"LLM Error with {model_name}: {str(e)}")
+            track_model_performance(model_name, success=False)
+            # Part of the reply has already been sent, so it cannot be retried
+            if started:
+                return
+    yield LLM_ERROR_REPLY
+
+async def _llm_chat_stream_async(prompt, task_complexity='medium'):
+    """Async variant of _llm_chat_stream"""
+    for model_name in _models_for_task(task_complexity):
+        started = False
+        try:
+            print(f"Using model: {model_name}")
+            model = _get_model(model_name)
+            response = await model.generate_content_async(prompt, stream=True)
+            async for chunk in response:
+                if chunk.text:
+                    started = True
+                    yield chunk.text
+            track_model_performance(model_name, success=True)
+            return
+        except Exception as e:
+            print(f"LLM Error with {model_name}: {str(e)}")
+            track_model_performance(model_name, success=False)
+            # Part of the reply has already been sent, so it cannot be retried
+            if started:
+                return
+    yield LLM_ERROR_REPLY
+
+# Static prompt prefixes. Keep these byte-identical and put all per-user
+# values after them so Gemini's implicit prompt cache can reuse the prefix.
+CLASSIFY_INTENT_PREAMBLE = """You are an AI assistant specialized in fashion and lifestyle. Analyze the user's message and classify their intent into one of these categories:
+
+- skincare
+- event_dressing
+- travel
+- music
+- general_recommendation
+
+Respond with only the category name."""
+
+EXTRACT_USER_INFO_PREAMBLE = """Extract user information from the message below. Look for:
+- Location
+- Body Type
+- Style Preferences
+- Budget
+
+Use "unknown" for anything the message does not mention.
+Respond in the format:
+Location: ...
+Body Type: ...
+Style Preferences: ...
+Budget: ..."""
+
+FASHION_SYSTEM_INSTRUCTION = """You are Cultura, an expert fashion and lifestyle assistant.
+You are a helpful assistant who can help the user with their fashion and lifestyle needs.
+
+Instructions:
+1. Provide recommendations as a numbered list (1., 2., 3., etc.).
+2. Do not use bold text, markdown, or special formatting.
+3. Keep the tone casual, friendly, and concise.
+4. Include specific product names, brands, and styling tips where possible.
+5. Ensure suggestions are relevant to the user's location, body type, style preferences, and budget.
+6. Keep the entire response under 300 words.
+7. If more details are needed (location, body type, budget), ask politely at the end.
+8. Do not use bold text, markdown, or special formatting."""
+
+FASHION_EXAMPLE_LIST = """1. Linen maxi dress from Mango — breathable and perfect for hot weather.
+2. Tailored blazer from Zara — works for both office and evening events.
+3. Leather sandals from Clarks — stylish yet comfortable for walking."""
+
+FASHION_FEW_SHOT_EXAMPLES = f"Example:\n{FASHION_EXAMPLE_LIST}"
+
+STATIC_FASHION_PREAMBLE = f"{FASHION_SYSTEM_INSTRUCTION}\n\n{FASHION_FEW_SHOT_EXAMPLES}"
+
+# Single-call prompt that classifies, extracts and answers at once
+FUSED_PREAMBLE = f"""{FASHION_SYSTEM_INSTRUCTION}
+
+Handle the user message below in one step and respond as JSON with these keys:
+- intent: one of skincare, event_dressing, travel, music, general_recommendation, greeting, or unknown if none fit
+- extracted_info: the location, body_type, style_preferences and budget the message mentions (use "unknown" for anything not mentioned)
+- recommendations: your reply to the user, following the instructions above
+
+Recommendations example:
+{FASHION_EXAMPLE_LIST}"""
+
+class ExtractedInfo(TypedDict):
+    location: str
+    body_type: str
+    style_preferences: str
+    budget: str
+
+class FusedResponse(TypedDict):
+    intent: str
+    extracted_info: ExtractedInfo
+    recommendations: str
+
+FUSED_GENERATION_CONFIG = {
+    'response_mime_type': 'application/json',
+    'response_schema': FusedResponse
+}
+
+# Embedding-based intent and greeting matching
+EMBEDDING_MODEL = 'models/text-embedding-004'
+INTENT_CATEGORIES = ['skincare', 'event_dressing', 'travel', 'music', 'general_recommendation']
+INTENT_SIMILARITY_THRESHOLD = 0.75
+GREETING_SIMILARITY_THRESHOLD = 0.85
+GREETING_REPLY = "Hey! I am Cultura, your personal stylist. How can I help you today?"
+
+INTENT_SEED_UTTERANCES = {
+    'skincare': [
+        "What skincare routine should I follow for oily skin?",
+        "Which moisturizer is good for dry skin in winter?",
+        "How do I get rid of acne marks?",
+        "Recommend a sunscreen that doesn't leave a white cast",
+        "What serum helps with dark spots?",
+        "My skin gets really dull, what products should I use?",
+        "Best night cream for sensitive skin",
+        "How often should I exfoliate my face?",
+        "Suggest a budget skincare routine for combination skin",
+        "What should I use for under-eye dark circles?",
+    ],
+    'event_dressing': [
+        "What should I wear to a wedding this weekend?",
+        "Outfit ideas for a cocktail party",
+        "I have a job interview tomorrow, what do I wear?",
+        "What to wear to a black tie gala?",
+        "Need a dress for my best friend's engagement party",
+        "What should I wear for a first date dinner?",
+        "Suggest an outfit for an office party",
+        "What do I wear to a graduation ceremony?",
+        "Ethnic wear ideas for a festival celebration",
+        "What's appropriate to wear to a funeral?",
+    ],
+    'travel': [
+        "What should I pack for a beach vacation?",
+        "Outfits for a winter trip to Switzerland",
+        "How do I pack light for a two week trip?",
+        "What to wear on a long flight?",
+        "Clothes to pack for a trekking trip in the mountains",
+        "What should I wear while sightseeing in Paris?",
+        "Travel capsule wardrobe for a business trip",
+        "What shoes are best for walking all day on vacation?",
+        "Packing list for a monsoon trip to Goa",
+        "What to wear for a road trip?",
+    ],
+    'music': [
+        "What should I wear to a rock concert?",
+        "Festival outfit ideas for Coachella",
+        "Outfit inspired by Taylor Swift's style",
+        "What to wear to a jazz night?",
+        "Give me a K-pop inspired look",
+        "What should I wear to a rave?",
+        "Outfit for a classical music recital",
+        "How do I dress like a 90s grunge band member?",
+        "What to wear to a Bollywood music night?",
+        "Concert outfit ideas that are comfortable to dance in",
+    ],
+    'general_recommendation': [
+        "How can I improve my everyday style?",
+        "What are the fashion trends this season?",
+        "Suggest some basics every wardrobe should have",
+        "What colors suit a warm skin tone?",
+        "How do I dress to look taller?",
+        "Recommend some affordable clothing brands",
+        "What shoes go with wide-leg jeans?",
+        "How do I build a minimalist wardrobe?",
+        "Casual outfit ideas for college",
+        "What accessories go well with a plain white shirt?",
+    ],
+}
+
+GREETING_SEED_UTTERANCES = [
+    "hey", "hi", "hello", "hola", "yo", "greetings",
+    "hi there", "hello there", "hey Cultura", "good morning", "good evening", "what's up",
+]
+
+# Lazily built L2-normalized seed matrices
+_seed_index = None
+_seed_index_lock = threading.Lock()
+
+def _embed_texts(texts):
+    """Embed a list of texts and return an L2-normalized matrix"""
+    result = _get_genai().embed_content(model=EMBEDDING_MODEL, content=texts, task_type='semantic_similarity')
+    matrix = np.asarray(result['embedding'], dtype=np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+def _get_seed_index():
+    """Build the seed embedding matrices once and reuse them across requests"""
+    global _seed_index
+    if _seed_index is not None:
+        return _seed_index
+    with _seed_index_lock:
+        if _seed_index is None:
+            intent_labels = []
+            intent_texts = []
+            for category, utterances in INTENT_SEED_UTTERANCES.items():
+                intent_labels.extend([category] * len(utterances))
+                intent_texts.extend(utterances)
+            _seed_index = {
+                'intent_labels': intent_labels,
+                'intent_matrix': _embed_texts(intent_texts),
+                'greeting_matrix': _embed_texts(GREETING_SEED_UTTERANCES)
+            }
+    return _seed_index
+
+async def _get_seed_index_async():
+    # Only the first call embeds the seeds; keep that off the event loop
+    if _seed_index is not None:
+        return _seed_index
+    return await asyncio.to_thread(_get_seed_index)
+
+def embed_message(message):
+    """Return the normalized embedding of a message, or None if embedding fails"""
     try:
-        if use_random_model:
-            model_name = random.choice(get_gemini_config()['available_models'])
-        else:
-            model_name = get_model_for_task(task_complexity)
-        
-        print(f"Using model: {model_name}")
-        model = genai.GenerativeModel(model_name)
-        response = model.generate_content(prompt)
-        return response.text.strip()
+        return _embed_texts([message])[0]
     except Exception as e:
-        print(f"LLM Error with {model_name}: {str(e)}")
-        try:
-            fallback_model = 'models/gemini-1.5-flash'
-            if model_name == fallback_model:
-                fallback_model = 'models/gemini-2.0-flash'
-            print(f"Trying fallback model: {fallback_model}")
-            model = genai.GenerativeModel(fallback_model)
-            response = model.generate_content(prompt)
-            return response.text.strip()
-        except Exception as fallback_error:
-            print(f"Fallback model also failed: {fallback_error}")
-            return "I'm having trouble generating a response right now. Please try again."
-
-def classify_intent(message):
-    """Classify the intent of the user's message"""
-    prompt = f"""
-    You are an AI assistant specialized in fashion and lifestyle. Analyze the user's message and classify their intent into one of these categories:
+        print(f"Embedding error: {e}")
+        return None
 
-    - skincare
-    - event_dressing
-    - travel
-    - music
-    - general_recommendation
+async def embed_message_async(message):
+    """Async variant of embed_message"""
+    try:
+        result = await _get_genai().embed_content_async(model=EMBEDDING_MODEL, content=message, task_type='semantic_similarity')
+        vector = np.asarray(result['embedding'], dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+    except Exception as e:
+        print(f"Embedding error: {e}")
+        return None
 
-    Message: "{message}"
-    Respond with only the category name.
-    """
-    return _llm_chat(prompt, task_complexity='simple', use_random_model=False)
+def _match_greeting(index, message_vec):
+    scores = index['greeting_matrix'] @ message_vec
+    return float(scores.max()) >= GREETING_SIMILARITY_THRESHOLD
+
+def _match_intent(index, message_vec):
+    """Return the nearest seed intent, or None if nothing is similar enough"""
+    scores = index['intent_matrix'] @ message_vec
+    best = int(np.argmax(scores))
+    if scores[best] > INTENT_SIMILARITY_THRESHOLD:
+        return index['intent_labels'][best]
+    return None
+
+def is_greeting(message_vec):
+    """Check whether a message embedding is close to a known greeting"""
+    if message_vec is None:
+        return False
+    try:
+        return _match_greeting(_get_seed_index(), message_vec)
+    except Exception as e:
+        print(f"Embedding error: {e}")
+        return False
+
+async def is_greeting_async(message_vec):
+    """Async variant of is_greeting"""
+    if message_vec is None:
+        return False
+    try:
+        return _match_greeting(await _get_seed_index_async(), message_vec)
+    except Exception as e:
+        print(f"Embedding error: {e}")
+        return False
+
+def _classify_intent_prompt(message):
+    return f'{CLASSIFY_INTENT_PREAMBLE}\n\nMessage: "{message}"'
+
+def classify_intent(message, message_vec=None):
+    """Classify the intent of the user's message"""
+    if message_vec is None:
+        message_vec = embed_message(message)
+    if message_vec is not None:
+        try:
+            intent = _match_intent(_get_seed_index(), message_vec)
+            if intent:
+                return intent
+        except Exception as e:
+            print(f"Embedding error: {e}")
+    return _llm_chat(_classify_intent_prompt(message), task_complexity='simple')
+
+async def classify_intent_async(message, message_vec=None):
+    """Async variant of classify_intent"""
+    if message_vec is None:
+        message_vec = await embed_message_async(message)
+    if message_vec is not None:
+        try:
+            intent = _match_intent(await _get_seed_index_async(), message_vec)
+            if intent:
+                return intent
+        except Exception as e:
+            print(f"Embedding error: {e}")
+    return await _llm_chat_async(_classify_intent_prompt(message), task_complexity='simple')
 
 def get_enhanced_location_info(location_string):
     """Get enhanced location information using polygon API"""
     if not location_string or location_string.lower() == 'unknown':
         return None
     try:
-        polygon_data = location_api.get_user_location_polygon(location_string)
-        if polygon_data:
-            return {
-                'original_query': location_string,
-                'display_name': polygon_data.get('display_name', ''),
-                'source': polygon_data.get('source', ''),
-                'bbox': polygon_data.get('bbox', []),
-                'polygon_available': True
-            }
+        polygon_data = _get_location_api().get_user_location_polygon(location_string)
     except Exception as e:
         print(f"Location API error: {e}")
+        polygon_data = None
+    return _build_enhanced_location(location_string, polygon_data)
+
+async def get_enhanced_location_info_async(location_string):
+    """Async variant of get_enhanced_location_info"""
+    if not location_string or location_string.lower() == 'unknown':
+        return None
+    try:
+        polygon_data = await _get_location_api().get_user_location_polygon_async(location_string)
+    except Exception as e:
+        print(f"Location API error: {e}")
+        polygon_data = None
+    return _build_enhanced_location(location_string, polygon_data)
+
+def _build_enhanced_location(location_string, polygon_data):
+    if polygon_data:
+        return {
+            'original_query': location_string,
+            'display_name': polygon_data.get('display_name', ''),
+            'source': polygon_data.get('source', ''),
+            'bbox': polygon_data.get('bbox', []),
+            'polygon_available': True
+        }
     return {
         'original_query': location_string,
         'polygon_available': False
     }
 
-def extract_user_info(message, user_id):
+def resolve_user_location(user_id):
+    """Geocode the user's stored location, reusing the previous result if unchanged"""
+    prefs = user_preferences.get(user_id, {})
+    location = prefs.get('location')
+    if not location:
+        return None
+    enhanced_location = prefs.get('enhanced_location')
+    if enhanced_location and enhanced_location.get('original_query') == location:
+        return enhanced_location
+    enhanced_location = get_enhanced_location_info(location)
+    if enhanced_location:
+        user_preferences.update(user_id, {'enhanced_location': enhanced_location})
+    return enhanced_location
+
+async def resolve_user_location_async(user_id):
+    """Async variant of resolve_user_location"""
+    # The preference store makes blocking Redis calls, so keep them off the event loop
+    prefs = await asyncio.to_thread(user_preferences.get, user_id, {})
+    location = prefs.get('location')
+    if not location:
+        return None
+    enhanced_location = prefs.get('enhanced_location')
+    if enhanced_location and enhanced_location.get('original_query') == location:
+        return enhanced_location
+    enhanced_location = await get_enhanced_location_info_async(location)
+    if enhanced_location:
+        await asyncio.to_thread(user_preferences.update, user_id, {'enhanced_location': enhanced_location})
+    return enhanced_location
+
+PROFILE_FIELDS = frozenset({'location', 'body_type', 'style_preferences', 'budget'})
+# Cheap signs that a message may change the stored location or budget
+_PROFILE_HINT_RE = re.compile(
+    r"\b(?:budget|live|living|based|moving|moved|relocat\w*|from|visiting|size)\b|[$€£₹¥]|\d",
+    re.IGNORECASE
+)
+
+def _can_skip_extraction(message, existing):
+    """True when the profile is complete and a short message is unlikely to change it"""
+    return (
+        PROFILE_FIELDS <= existing.keys()
+        and len(message.split()) < 20
+        and not _PROFILE_HINT_RE.search(message)
+    )
+
+def extract_user_info(message, user_id, resolve_location=True):
     """Extract and store user preferences"""
-    prompt = f"""
-    Extract user information from this message. Look for:
-    - Location
-    - Body Type
-    - Style Preferences
-    - Budget
-
-    Message: "{message}"
-    Respond in the format:
-    Location: ...
-    Body Type: ...
-    Style Preferences: ...
-    Budget: ...
-    """
+    existing = user_preferences.get(user_id, {})
+    if _can_skip_extraction(message, existing):
+        return existing
+    prompt = f'{EXTRACT_USER_INFO_PREAMBLE}\n\nMessage: "{message}"'
     extracted = _llm_chat(prompt, task_complexity='medium')
-    if user_id not in user_preferences:
-        user_preferences[user_id] = {}
-    lines = extracted.strip().split('\n')
-    for line in lines:
-        if 'Location:' in line:
-            location = line.split('Location:')[1].strip()
-            if location != "unknown":
-                user_preferences[user_id]['location'] = location
-                enhanced_location = get_enhanced_location_info(location)
-                if enhanced_location:
-                    user_preferences[user_id]['enhanced_location'] = enhanced_location
-        elif 'Body Type:' in line:
-            body_type = line.split('Body Type:')[1].strip()
-            if body_type != "unknown":
-                user_preferences[user_id]['body_type'] = body_type
-        elif 'Style Preferences:' in line:
-            style = line.split('Style Preferences:')[1].strip()
-            if style != "unknown":
-                user_preferences[user_id]['style_preferences'] = style
-        elif 'Budget:' in line:
-            budget = line.split('Budget:')[1].strip()
-            if budget != "unknown":
-                user_preferences[user_id]['budget'] = budget
-    return user_preferences[user_id]
+    prefs = _store_user_info(extracted, user_id)
+    if resolve_location:
+        resolve_user_location(user_id)
+        prefs = user_preferences.get(user_id, prefs)
+    return prefs
 
-def generate_fashion_response(message, intent_category, user_id):
-    """Generate a fashion/lifestyle recommendation"""
+async def extract_user_info_async(message, user_id):
+    """Async variant of extract_user_info; geocoding is left to the caller"""
+    existing = await asyncio.to_thread(user_preferences.get, user_id, {})
+    if _can_skip_extraction(message, existing):
+        return existing
+    prompt = f'{EXTRACT_USER_INFO_PREAMBLE}\n\nMessage: "{message}"'
+    extracted = await _llm_chat_async(prompt, task_complexity='medium')
+    return await asyncio.to_thread(_store_user_info, extracted, user_id)
+
+# One pass over the extraction reply; tolerates leading bullets and stray spaces
+_EXTRACT_RE = re.compile(r'^[ \t\-*]*(Location|Body Type|Style Preferences|Budget)[ \t]*:[ \t]*(\S.*?)[ \t\r]*$', re.MULTILINE)
+EXTRACT_FIELD_MAP = {
+    'Location': 'location',
+    'Body Type': 'body_type',
+    'Style Preferences': 'style_preferences',
+    'Budget': 'budget'
+}
+
+def _store_user_info(extracted, user_id):
+    """Parse the LLM extraction reply into user_preferences"""
+    fields = {}
+    for key, value in _EXTRACT_RE.findall(extracted):
+        if value.lower() != "unknown":
+            fields[EXTRACT_FIELD_MAP[key]] = value
+    prefs = user_preferences.update(user_id, fields)
+    return prefs if prefs is not None else fields
+
+def _user_profile_context(user_id):
+    """Describe what we know about the user for the prompt"""
     user_info = user_preferences.get(user_id, {})
     location = user_info.get('location', 'unknown')
     enhanced_location = user_info.get('enhanced_location', {})
@@ -150,82 +627,248 @@ def generate_fashion_response(message, intent_category, user_id):
 
     location_context = ""
     if enhanced_location and enhanced_location.get('polygon_available'):
-        location_context = f"""
-        Enhanced Location Information:
-        - User mentioned: {location}
-        - Full location: {enhanced_location.get('display_name', '')}
-        """
+        location_context = (
+            "Enhanced Location Information:\n"
+            f"- User mentioned: {location}\n"
+            f"- Full location: {enhanced_location.get('display_name', '')}"
+        )
     elif location != 'unknown':
         location_context = f"User Location: {location}"
 
-    prompt = f"""
-    You are Cultura, an expert fashion and lifestyle assistant. 
-    You are a helpful assistant who can help the user with their fashion and lifestyle needs.
-
-    Instructions:
-    1. Provide recommendations as a numbered list (1., 2., 3., etc.).
-    2. Do not use bold text, markdown, or special formatting.
-    3. Keep the tone casual, friendly, and concise.
-    4. Include specific product names, brands, and styling tips where possible.
-    5. Ensure suggestions are relevant to the user's location, body type, style preferences, and budget.
-    6. Keep the entire response under 300 words.
-    7. If more details are needed (location, body type, budget), ask politely at the end.
-    8. Do not use bold text, markdown, or special formatting.
-
-    Example:
-    1. Linen maxi dress from Mango — breathable and perfect for hot weather.
-    2. Tailored blazer from Zara — works for both office and evening events.
-    3. Leather sandals from Clarks — stylish yet comfortable for walking.
-
-    {location_context}
-
-    User Information:
-    - Body Type: {body_type}
-    - Style Preferences: {style_preferences}
-    - Budget: {budget}
-    - Intent Category: {intent_category}
-
-    User Message: "{message}"
-    """
+    return (
+        f"{location_context}\n\n"
+        "User Information:\n"
+        f"- Body Type: {body_type}\n"
+        f"- Style Preferences: {style_preferences}\n"
+        f"- Budget: {budget}"
+    )
+
+def _store_extracted_fields(extracted_info, user_id):
+    """Store the non-unknown fields of a fused-call extracted_info dict"""
+    fields = {}
+    for field in ('location', 'body_type', 'style_preferences', 'budget'):
+        value = str(extracted_info.get(field) or '').strip()
+        if value and value.lower() != 'unknown':
+            fields[field] = value
+    if fields:
+        user_preferences.update(user_id, fields)
+
+def _fashion_user_context(message, intent_category, user_id):
+    """Build the per-user part of the fashion prompt"""
+    return (
+        f"{_user_profile_context(user_id)}\n"
+        f"- Intent Category: {intent_category}\n\n"
+        f'User Message: "{message}"'
+    )
+
+def generate_fashion_response(message, intent_category, user_id):
+    """Generate a fashion/lifestyle recommendation"""
+    user_context = _fashion_user_context(message, intent_category, user_id)
+    prompt = f"{STATIC_FASHION_PREAMBLE}\n\n{user_context}"
     return _llm_chat(prompt, task_complexity='complex')
 
-# Model performance tracking
-model_performance = {model: {'success': 0, 'failures': 0} for model in get_gemini_config()['available_models']}
+def _fused_prompt(message, user_id):
+    return f'{FUSED_PREAMBLE}\n\n{_user_profile_context(user_id)}\n\nUser Message: "{message}"'
+
+def _parse_fused_response(text):
+    """Parse the fused JSON reply; None if it is unusable"""
+    try:
+        result = json.loads(text)
+    except ValueError:
+        print(f"Fused response was not valid JSON: {text[:200]}")
+        return None
+    if not isinstance(result, dict) or not isinstance(result.get('intent'), str):
+        return None
+    if not isinstance(result.get('extracted_info'), dict):
+        result['extracted_info'] = {}
+    return result
+
+def fused_process(message, user_id):
+    """Classify, extract user info and generate recommendations in a single LLM call"""
+    text = _llm_chat(_fused_prompt(message, user_id), task_complexity='complex', generation_config=FUSED_GENERATION_CONFIG)
+    return _parse_fused_response(text)
+
+def _reply_from_fused(result, user_id):
+    """Store extracted info from a fused result and pick the reply to send"""
+    _store_extracted_fields(result['extracted_info'], user_id)
+    intent = result['intent'].strip().lower()
+    if intent == 'greeting':
+        return GREETING_REPLY
+    recommendations = result.get('recommendations')
+    if intent not in INTENT_CATEGORIES or not isinstance(recommendations, str) or not recommendations.strip():
+        return UNCLEAR_REPLY
+    return recommendations.strip()
+
+# Model performance tracking. Attempts are counted in a lock-protected in-process
+# Counter; when Redis is configured a background thread flushes the increments
+# with one pipelined HINCRBY batch, so LLM calls never wait on Redis.
+MODEL_PERF_FLUSH_INTERVAL = 10  # seconds
+_model_counts = Counter()  # (model_name, 'success' | 'failures') -> count
+_pending_model_counts = Counter()  # Increments not yet flushed to Redis
+_model_counts_lock = threading.Lock()
+_model_perf_flusher = None
+
+def _flush_model_counts():
+    """Push pending counter increments to Redis"""
+    with _model_counts_lock:
+        pending = _pending_model_counts.copy()
+        _pending_model_counts.clear()
+    if not pending:
+        return
+    try:
+        pipe = get_redis_client().pipeline(transaction=False)
+        for (model_name, outcome), count in pending.items():
+            pipe.hincrby(f"model_perf:{model_name}", outcome, count)
+        pipe.execute()
+    except Exception as e:
+        print(f"Redis error: {e}")
+        with _model_counts_lock:
+            _pending_model_counts.update(pending)
+
+def _run_model_perf_flusher():
+    while True:
+        time.sleep(MODEL_PERF_FLUSH_INTERVAL)
+        _flush_model_counts()
 
 def track_model_performance(model_name, success=True):
-    if success:
-        model_performance[model_name]['success'] += 1
-    else:
-        model_performance[model_name]['failures'] += 1
+    global _model_perf_flusher
+    key = (model_name, 'success' if success else 'failures')
+    use_redis = get_redis_client() is not None
+    with _model_counts_lock:
+        _model_counts[key] += 1
+        if use_redis:
+            _pending_model_counts[key] += 1
+            if _model_perf_flusher is None:
+                _model_perf_flusher = threading.Thread(target=_run_model_perf_flusher, daemon=True)
+                _model_perf_flusher.start()
+
+def get_model_performance(model_name):
+    """Return {'success': n, 'failures': m} for a model"""
+    client = get_redis_client()
+    if client is not None:
+        try:
+            stats = client.hgetall(f"model_perf:{model_name}")
+            with _model_counts_lock:
+                return {
+                    outcome: int(stats.get(outcome.encode(), 0)) + _pending_model_counts[(model_name, outcome)]
+                    for outcome in ('success', 'failures')
+                }
+        except Exception as e:
+            print(f"Redis error: {e}")
+    with _model_counts_lock:
+        return {'success': _model_counts[(model_name, 'success')], 'failures': _model_counts[(model_name, 'failures')]}
 
 def get_best_performing_model():
     best_model = None
     best_ratio = 0
-    for model, stats in model_performance.items():
+    available_models = get_gemini_config()['available_models']
+    for model in available_models:
+        stats = get_model_performance(model)
         total = stats['success'] + stats['failures']
         if total > 0:
             ratio = stats['success'] / total
             if ratio > best_ratio:
                 best_ratio = ratio
                 best_model = model
-    return best_model or get_gemini_config()['available_models'][0]
+    return best_model or available_models[0]
+
+UNCLEAR_REPLY = "Hey, I didn't understand you. Could you please elaborate?"
+GREETINGS = frozenset({"hey", "hi", "hello", "hola", "yo", "greetings"})
+_ALNUM_RE = re.compile(r"[a-zA-Z0-9]+")
+
+def _quick_reply(message):
+    """Canned reply for exact greetings and bare single words, else None"""
+    stripped = message.strip()
+    if stripped.lower() in GREETINGS:
+        return GREETING_REPLY
+    # A single alphanumeric word (not a greeting) gives us nothing to work with
+    if _ALNUM_RE.fullmatch(stripped):
+        return UNCLEAR_REPLY
+    return None
 
 def process_user_message(message, user_id):
-    extract_user_info(message, user_id)
-    greetings = ["hey", "hi", "hello", "hola", "yo", "greetings"]
-    if message.strip().lower() in greetings:
-        return "Hey! I am Cultura, your personal stylist. How can I help you today?"
-    if (len(message.strip().split()) == 1 and message.strip().lower() not in greetings):
-        if re.fullmatch(r"[a-zA-Z0-9]+", message.strip()):
-            return "Hey, I didn't understand you. Could you please elaborate?"
-    intent = classify_intent(message)
-    if intent not in ['skincare', 'event_dressing', 'travel', 'music', 'general_recommendation']:
-        return "Hey, I didn't understand you. Could you please elaborate?"
+    if _quick_reply(message) is None:
+        # Geocode the stored location first so the fused prompt can use it
+        resolve_user_location(user_id)
+        result = fused_process(message, user_id)
+        if result is not None:
+            return _reply_from_fused(result, user_id)
+    return _process_user_message_stepwise(message, user_id)
+
+def _prepare_stepwise(message, user_id):
+    """Run extraction, classification and geocoding; return (early_reply, intent)"""
+    # Extraction, embedding/intent classification and geocoding are independent
+    # network calls, so overlap them instead of running them back to back
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        extract_future = executor.submit(extract_user_info, message, user_id, False)
+        reply = _quick_reply(message)
+        if reply:
+            return reply, None
+        # Embed once and reuse the vector for greeting and intent matching
+        message_vec = embed_message(message)
+        if is_greeting(message_vec):
+            return GREETING_REPLY, None
+        intent_future = executor.submit(classify_intent, message, message_vec)
+        extract_future.result()
+        location_future = executor.submit(resolve_user_location, user_id)
+        intent = intent_future.result()
+        location_future.result()
+    if intent not in INTENT_CATEGORIES:
+        return UNCLEAR_REPLY, None
+    return None, intent
+
+def _process_user_message_stepwise(message, user_id):
+    """Separate extract/classify/generate calls; used for quick replies and when the fused call fails"""
+    reply, intent = _prepare_stepwise(message, user_id)
+    if reply:
+        return reply
     return generate_fashion_response(message, intent, user_id)
 
+def stream_user_message(message, user_id):
+    """Yield the reply to a message in chunks as the LLM generates it"""
+    reply, intent = _prepare_stepwise(message, user_id)
+    if reply:
+        yield reply
+        return
+    prompt = f"{STATIC_FASHION_PREAMBLE}\n\n{_fashion_user_context(message, intent, user_id)}"
+    yield from _llm_chat_stream(prompt, task_complexity='complex')
+
+async def _prepare_stepwise_async(message, user_id):
+    """Async variant of _prepare_stepwise using asyncio.gather"""
+    extract_task = asyncio.create_task(extract_user_info_async(message, user_id))
+    reply = _quick_reply(message)
+    if reply is None:
+        message_vec = await embed_message_async(message)
+        if await is_greeting_async(message_vec):
+            reply = GREETING_REPLY
+    if reply:
+        await extract_task
+        return reply, None
+    intent_task = asyncio.create_task(classify_intent_async(message, message_vec))
+    await extract_task
+    intent, _ = await asyncio.gather(intent_task, resolve_user_location_async(user_id))
+    if intent not in INTENT_CATEGORIES:
+        return UNCLEAR_REPLY, None
+    return None, intent
+
+async def stream_user_message_async(message, user_id):
+    """Async variant of stream_user_message"""
+    reply, intent = await _prepare_stepwise_async(message, user_id)
+    if reply:
+        yield reply
+        return
+    user_context = await asyncio.to_thread(_fashion_user_context, message, intent, user_id)
+    prompt = f"{STATIC_FASHION_PREAMBLE}\n\n{user_context}"
+    async for chunk in _llm_chat_stream_async(prompt, task_complexity='complex'):
+        yield chunk
+
+def format_response(response):
+    """Turn escaped newlines from the LLM into real line breaks"""
+    return response.replace('\\n', '\n').strip()
+
 def handle_telegram_message(message_text, user_id):
     try:
         response = process_user_message(message_text, user_id)
-        return response.replace('\\n', '\n')
+        return format_response(response)
     except Exception as e:
         return f"Sorry, I encountered an error: {str(e)}. Please try again! 😊"
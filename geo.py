@@ -1,52 +1,165 @@
+import asyncio
+import re
+import threading
+import unicodedata
 import requests
+import httpx
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+import diskcache
+from cachetools import TTLCache
 from typing import Dict, Optional
 
+from config import GEO_CACHE_DIR
+
+# Geocoding results barely change, so cache them for a day in memory and on disk
+GEO_CACHE_TTL = 86400
+_memory_cache = TTLCache(maxsize=10_000, ttl=GEO_CACHE_TTL)
+_memory_cache_lock = threading.Lock()
+_disk_cache = None
+_disk_cache_lock = threading.Lock()
+
+def normalize_location_query(location_query: str) -> str:
+    """Normalize a location query so trivial variants share a cache entry"""
+    text = unicodedata.normalize('NFKC', location_query).casefold()
+    text = re.sub(r'\s*,\s*', ', ', text)
+    return re.sub(r'\s+', ' ', text).strip(' ,.')
+
+def _get_disk_cache():
+    """Open the on-disk geocode cache on first use; None if it is unavailable"""
+    global _disk_cache
+    if _disk_cache is None:
+        with _disk_cache_lock:
+            if _disk_cache is None:
+                try:
+                    _disk_cache = diskcache.Cache(GEO_CACHE_DIR)
+                except Exception as e:
+                    print(f"Geo disk cache unavailable: {e}")
+                    _disk_cache = False
+    return _disk_cache or None
+
+def _cache_get(key: str) -> Optional[Dict]:
+    with _memory_cache_lock:
+        data = _memory_cache.get(key)
+    if data is None:
+        disk_cache = _get_disk_cache()
+        if disk_cache is not None:
+            data = disk_cache.get(key)
+            if data is not None:
+                with _memory_cache_lock:
+                    _memory_cache[key] = data
+    return data
+
+def _cache_set(key: str, data: Dict):
+    with _memory_cache_lock:
+        _memory_cache[key] = data
+    disk_cache = _get_disk_cache()
+    if disk_cache is not None:
+        try:
+            disk_cache.set(key, data, expire=GEO_CACHE_TTL)
+        except Exception as e:
+            # The memory cache still holds the result; a disk failure must not lose it
+            print(f"Geo disk cache write failed: {e}")
+
 class LocationAPI:
     """Simple location API using free Nominatim service"""
     
     def __init__(self):
         self.base_url = 'https://nominatim.openstreetmap.org/search'
+        # Nominatim's usage policy requires an identifying User-Agent
+        self.headers = {'User-Agent': 'CulturaBot/1.0 (https://t.me/auracurator_bot)'}
+        self.timeout = 10
+        # Keep-alive session so repeat lookups reuse the TLS connection
+        self._session = requests.Session()
+        self._session.headers.update(self.headers)
+        retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+        self._session.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retry))
+        # Long-lived httpx.AsyncClient injected by the host app; None opens one per call
+        self.async_client = None
+
+    def _build_params(self, location_query: str) -> Dict:
+        return {
+            'q': location_query,
+            'format': 'json',
+            'limit': 1,
+            'addressdetails': 1
+        }
+
+    def _parse_results(self, results) -> Optional[Dict]:
+        if not results:
+            return None
+        result = results[0]
+        return {
+            'display_name': result.get('display_name', ''),
+            'source': 'nominatim',
+            'latitude': float(result.get('lat', 0)),
+            'longitude': float(result.get('lon', 0)),
+            'bbox': result.get('boundingbox', []),
+            'address': result.get('address', {}),
+            'place_id': result.get('place_id', ''),
+            'importance': result.get('importance', 0)
+        }
         
     def get_user_location_polygon(self, location_query: str) -> Optional[Dict]:
         """Get location data using free Nominatim service"""
         if not location_query or location_query.lower() == 'unknown':
             return None
+
+        cache_key = normalize_location_query(location_query)
+        cached = _cache_get(cache_key)
+        if cached is not None:
+            return cached
             
         try:
-            params = {
-                'q': location_query,
-                'format': 'json',
-                'limit': 1,
-                'addressdetails': 1
-            }
-            
-            
-            response = requests.get(
+            response = self._session.get(
                 self.base_url, 
-                params=params, 
-                headers=headers,
-                timeout=10
+                params=self._build_params(location_query), 
+                timeout=self.timeout
             )
             
-            if response.status_code == 200:
-                results = response.json()
-                if results:
-                    result = results[0]
-                    return {
-                        'display_name': result.get('display_name', ''),
-                        'source': 'nominatim',
-                        'latitude': float(result.get('lat', 0)),
-                        'longitude': float(result.get('lon', 0)),
-                        'bbox': result.get('boundingbox', []),
-                        'address': result.get('address', {}),
-                        'place_id': result.get('place_id', ''),
-                        'importance': result.get('importance', 0)
-                    }
+            if response.status_code != 200:
+                return None
+            data = self._parse_results(response.json())
                     
         except Exception as e:
             print(f"Location API error: {e}")
+            return None
             
-        return None
+        if data:
+            _cache_set(cache_key, data)
+        return data
+
+    async def get_user_location_polygon_async(self, location_query: str) -> Optional[Dict]:
+        """Async variant of get_user_location_polygon using httpx"""
+        if not location_query or location_query.lower() == 'unknown':
+            return None
+
+        cache_key = normalize_location_query(location_query)
+        # The disk cache is sqlite, so keep its I/O off the event loop
+        cached = await asyncio.to_thread(_cache_get, cache_key)
+        if cached is not None:
+            return cached
+
+        try:
+            if self.async_client is not None:
+                response = await self.async_client.get(
+                    self.base_url, params=self._build_params(location_query), headers=self.headers, timeout=self.timeout
+                )
+            else:
+                async with httpx.AsyncClient(headers=self.headers, timeout=self.timeout) as client:
+                    response = await client.get(self.base_url, params=self._build_params(location_query))
+
+            if response.status_code != 200:
+                return None
+            data = self._parse_results(response.json())
+
+        except Exception as e:
+            print(f"Location API error: {e}")
+            return None
+
+        if data:
+            await asyncio.to_thread(_cache_set, cache_key, data)
+        return data
     
     def get_location_info(self, location: str) -> Dict:
         """Get structured location information"""
@@ -64,4 +177,4 @@ class LocationAPI:
             'display_name': data.get('display_name'),
             'found': True
 
-        }
+        }
\ No newline at end of file
@@ -0,0 +1,9 @@
+import multiprocessing
+import os
+
+# Gunicorn settings for serving the Flask app (see wsgi.py)
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', 2 * multiprocessing.cpu_count() + 1))
+worker_class = 'gevent'
+worker_connections = 1000
+timeout = 60
@@ -1,29 +1,429 @@
 # Enhanced location-based fashion recommendations with LLM classification
-from typing import Dict, List, Optional
+from typing import Dict, List, Mapping, Optional, Tuple
+from types import MappingProxyType
+import os
 import json
+import logging
 import re
-from geo import LocationAPI
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import diskcache
+import fastjsonschema
+import numpy as np
+import ahocorasick
+from geo import LocationAPI, normalize_location_query
+from config import LOCATION_CACHE_DIR, GAZETTEER_PATH, configure_logging
+from gemini_utils import LLM_ERROR_REPLY, embed_message
+
+logger = logging.getLogger(__name__)
+
+# Classifications of a city hardly change; geocoded location data is refreshed daily
+CLASSIFICATION_CACHE_TTL = 30 * 86400
+LOCATION_CACHE_TTL = 86400
+SEMANTIC_MATCH_THRESHOLD = 0.92
+
+# Concurrent classification requests are coalesced into one LLM call per window
+CLASSIFICATION_BATCH_WINDOW = 0.075
+MAX_CLASSIFICATION_BATCH = 16
+
+CLASSIFICATION_JSON_FORMAT = """{
+    "region": "geographical region (e.g., south_asia, europe, north_america, southeast_asia, middle_east, africa, oceania)",
+    "climate_zone": "climate type (tropical, subtropical, temperate, arid, continental, oceanic, mountain)",
+    "fashion_market": "market classification (indian, american, european, british, japanese, etc.)",
+    "local_brands": ["list of 6-8 popular local fashion brands actually available in this location"],
+    "available_stores": ["list of 6-8 popular stores/retailers in this location"],
+    "online_platforms": ["list of popular online shopping platforms for this region"],
+    "cultural_considerations": ["list of 3-5 cultural factors affecting fashion choices"],
+    "seasonal_info": "brief description of seasonal fashion needs and weather patterns",
+    "price_range_info": "typical price ranges and currency information",
+    "popular_styles": ["list of 4-6 popular fashion styles in this region"],
+    "climate_recommendations": {
+        "fabrics": ["recommended fabric types for this climate"],
+        "colors": ["suitable color palettes"],
+        "styles": ["appropriate clothing styles"],
+        "essentials": ["weather-essential items"]
+    }
+}"""
+
+# Prompts are a static prefix built once at import plus a small formatted tail, so
+# per-request work scales with the dynamic fields and the shared prefix stays
+# byte-identical across calls (which also lets Gemini's implicit prefix caching hit)
+_CLASSIFICATION_PROMPT_PREFIX = """
+        You are a global fashion market expert. Analyze the location below and provide comprehensive fashion market information.
+        
+        Provide information in this exact JSON format:
+        """ + CLASSIFICATION_JSON_FORMAT + """
+        
+        Be accurate and specific. Only include brands/stores that are actually available in this location.
+        Consider the local climate, culture, economy, and fashion preferences.
+        """
+
+_CLASSIFICATION_PROMPT_TAIL = """
+        Location: {display_name}
+        City: {city}
+        Country: {country}
+        """
+
+_BATCH_CLASSIFICATION_PROMPT_PREFIX = """
+        You are a global fashion market expert. Analyze each of the numbered locations below and provide comprehensive fashion market information.
+        
+        Return a JSON array with exactly one object per location, in the same order as the locations, each in this exact format:
+        """ + CLASSIFICATION_JSON_FORMAT + """
+        
+        Be accurate and specific. Only include brands/stores that are actually available in each location.
+        Consider the local climate, culture, economy, and fashion preferences.
+        
+        """
+
+_BATCH_LOCATION_LINE = "{index}. Location: {display_name} | City: {city} | Country: {country}"
+
+_ENHANCED_PROMPT_PREFIX = """
+        You are Cultura, a location-aware fashion expert with access to comprehensive location data.
+        
+        INSTRUCTIONS:
+        1. Provide fashion advice using SPECIFIC brands and stores from the local ecosystem below
+        2. Consider the climate zone and cultural factors for appropriateness
+        3. Include specific product recommendations with styling tips
+        4. Mention where they can shop (specific stores/online platforms)
+        5. Consider the local price range and popular styles
+        6. Give 3-5 concrete, actionable recommendations
+        
+        Keep response under 300 words. Be enthusiastic and specific. Use occasional emojis. No markdown formatting.
+        """
+
+_ENHANCED_PROMPT_TAIL = """
+        LOCATION DETAILS:
+        - City: {city}
+        - State/Region: {state}
+        - Country: {country}
+        - Region: {region}
+        - Climate Zone: {climate_zone}
+        - Fashion Market: {fashion_market}
+        
+        LOCAL FASHION ECOSYSTEM:
+        - Available Local Brands: {local_brands}
+        - Popular Stores: {available_stores}
+        - Online Platforms: {online_platforms}
+        - Price Range: {price_range_info}
+        
+        CULTURAL & CLIMATE CONTEXT:
+        - Cultural Considerations: {cultural_considerations}
+        - Popular Local Styles: {popular_styles}
+        - Seasonal Info: {seasonal_info}
+        
+        CLIMATE-APPROPRIATE RECOMMENDATIONS:
+        - Recommended Fabrics: {fabrics}
+        - Suitable Colors: {colors}
+        - Style Suggestions: {styles}
+        - Weather Essentials: {essentials}
+        
+        USER MESSAGE: "{user_message}"
+        """
+
+# Scalar and list slots of the enhanced prompt with their defaults
+_ENHANCED_PROMPT_DEFAULTS = {
+    'city': 'Unknown', 'state': 'Unknown', 'country': 'Unknown', 'region': 'unknown',
+    'climate_zone': 'temperate', 'fashion_market': 'international',
+    'price_range_info': 'Varies', 'seasonal_info': 'Varies by season',
+}
+_ENHANCED_PROMPT_LIST_FIELDS = ('local_brands', 'available_stores', 'online_platforms', 'cultural_considerations', 'popular_styles')
+_CLIMATE_REC_FIELDS = ('fabrics', 'colors', 'styles', 'essentials')
+
+# Classification schema compiled once into a validator that also fills in defaults
+# List items must be strings: the prompt builder joins them with ', '
+_STRING_LIST_SCHEMA = {'type': 'array', 'items': {'type': 'string'}, 'default': []}
+_CLASSIFICATION_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'region': {'type': 'string', 'default': 'unknown'},
+        'climate_zone': {'type': 'string', 'default': 'unknown'},
+        'fashion_market': {'type': 'string', 'default': 'unknown'},
+        'seasonal_info': {'type': 'string', 'default': _ENHANCED_PROMPT_DEFAULTS['seasonal_info']},
+        'price_range_info': {'type': 'string', 'default': _ENHANCED_PROMPT_DEFAULTS['price_range_info']},
+        **{field: _STRING_LIST_SCHEMA for field in _ENHANCED_PROMPT_LIST_FIELDS},
+        'climate_recommendations': {
+            'type': 'object',
+            'properties': {field: _STRING_LIST_SCHEMA for field in _CLIMATE_REC_FIELDS},
+            'default': {field: [] for field in _CLIMATE_REC_FIELDS},
+        },
+    },
+}
+_validate_classification = fastjsonschema.compile(_CLASSIFICATION_SCHEMA, use_default=True)
+_CLASSIFICATION_TEXT_FIELDS = ('region', 'climate_zone', 'fashion_market', 'seasonal_info', 'price_range_info')
+
+def _string_items(value) -> Optional[List[str]]:
+    return [item for item in value if isinstance(item, str)] if isinstance(value, list) else None
+
+def _normalize_classification(data) -> Dict:
+    """Validate a classification, dropping only the fields that have the wrong type"""
+    if not isinstance(data, dict):
+        raise ValueError("Classification is not a JSON object")
+    try:
+        return _validate_classification(data)
+    except fastjsonschema.JsonSchemaException as e:
+        logger.warning("Classification schema error, dropping invalid fields: %s", e)
+    clean = {key: data[key] for key in _CLASSIFICATION_TEXT_FIELDS if isinstance(data.get(key), str)}
+    for key in _ENHANCED_PROMPT_LIST_FIELDS:
+        items = _string_items(data.get(key))
+        if items is not None:
+            clean[key] = items
+    recs = data.get('climate_recommendations')
+    if isinstance(recs, dict):
+        clean['climate_recommendations'] = {
+            key: _string_items(recs[key]) for key in _CLIMATE_REC_FIELDS if isinstance(recs.get(key), list)
+        }
+    return _validate_classification(clean)
+
+class TextClassification(Exception):
+    """Carries a best-effort classification parsed from a non-JSON reply; never cached"""
+
+    def __init__(self, classification: Dict):
+        super().__init__("LLM reply was not classification JSON")
+        self.classification = classification
+
+# Country -> region table for the fallback classifier when the LLM is unavailable;
+# fallback values are tuples so the shared constant cannot be mutated by callers
+_COUNTRY_TO_REGION = {
+    'india': 'south_asia', 'pakistan': 'south_asia', 'bangladesh': 'south_asia', 'sri lanka': 'south_asia',
+    'united states': 'north_america', 'united states of america': 'north_america', 'usa': 'north_america',
+    'canada': 'north_america',
+    'united kingdom': 'europe', 'uk': 'europe', 'france': 'europe', 'germany': 'europe', 'deutschland': 'europe',
+    'spain': 'europe', 'españa': 'europe', 'italy': 'europe', 'italia': 'europe',
+}
+_REGION_CLIMATE = {'south_asia': 'tropical'}
+_FALLBACK_DATA = {
+    'region': 'unknown',
+    'climate_zone': 'temperate',
+    'fashion_market': 'international',
+    'local_brands': ('Zara', 'H&M', 'Uniqlo'),
+    'available_stores': ('Local malls', 'Online retailers'),
+    'online_platforms': ('Amazon', 'Local e-commerce'),
+    'cultural_considerations': ('Weather appropriate', 'Occasion suitable'),
+    'seasonal_info': 'Four seasons with varying temperatures',
+    'price_range_info': 'Mid-range pricing',
+    'popular_styles': ('Casual', 'Smart casual', 'Formal'),
+    'climate_recommendations': {
+        'fabrics': ('Cotton', 'Polyester blends'),
+        'colors': ('Neutral tones', 'Seasonal colors'),
+        'styles': ('Layerable pieces', 'Versatile basics'),
+        'essentials': ('Jacket', 'Comfortable shoes')
+    }
+}
+
+# Read-only climate fallbacks shared by every call
+_FALLBACK_CLIMATE_RECS = MappingProxyType({
+    'tropical': MappingProxyType({
+        'fabrics': ('cotton', 'linen', 'breathable synthetics', 'modal'),
+        'colors': ('light colors', 'pastels', 'whites', 'bright colors'),
+        'styles': ('loose fitting', 'sleeveless', 'midi dresses', 'palazzo pants'),
+        'essentials': ('sun hat', 'sunglasses', 'light scarf', 'comfortable sandals')
+    }),
+    'arid': MappingProxyType({
+        'fabrics': ('cotton', 'linen', 'lightweight wool'),
+        'colors': ('earth tones', 'light colors', 'avoid dark colors'),
+        'styles': ('full coverage', 'loose fitting', 'long sleeves'),
+        'essentials': ('wide-brimmed hat', 'sunglasses', 'scarf', 'closed shoes')
+    }),
+    'temperate': MappingProxyType({
+        'fabrics': ('cotton', 'wool blends', 'denim', 'knits'),
+        'colors': ('versatile neutrals', 'seasonal colors'),
+        'styles': ('layerable pieces', 'versatile basics'),
+        'essentials': ('light jacket', 'comfortable shoes', 'scarf')
+    })
+})
+
+# Location mention patterns in priority order, compiled once at import. Each runs as
+# its own scan: a merged alternation would let one match consume text another needs
+_LOCATION_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in (
+    r"(?:from|in|at|live in|based in|located in)\s+([A-Z][a-zA-Z\s,]+)",
+    r"([A-Z][a-zA-Z\s]+,\s*[A-Z][a-zA-Z\s]+)",  # City, Country
+    r"\b([A-Z][a-zA-Z]+(?:\s+[A-Z][a-zA-Z]+)*)\b(?=\s+(?:city|area|region))",
+    r"I'm in ([A-Z][a-zA-Z\s,]+)",
+)]
+_LOCATION_STOPWORDS = frozenset(['the', 'and', 'for', 'with'])
+_LOCATION_PREPOSITION_RE = re.compile(r"\b(?:from|in|at|to|near|around|visiting)\s+$")
+
+def _load_gazetteer(path: Optional[str]):
+    """Build an Aho-Corasick automaton over a GeoNames city dump; None if not configured"""
+    if not path or not os.path.exists(path):
+        return None
+    automaton = ahocorasick.Automaton()
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                # GeoNames columns: geonameid, name, asciiname, ...
+                fields = line.split('\t', 3)
+                if len(fields) < 3:
+                    continue
+                for name in (fields[1].strip(), fields[2].strip()):
+                    key = name.lower()
+                    if len(key) > 2 and key not in _LOCATION_STOPWORDS:
+                        automaton.add_word(key, (len(key), name))
+        automaton.make_automaton()
+    except Exception as e:
+        logger.warning("Gazetteer load error: %s", e)
+        return None
+    return automaton
+
+_GAZETTEER = _load_gazetteer(GAZETTEER_PATH)
+
+_ASSISTANT_SINGLETON = None
+_ASSISTANT_LOCK = threading.Lock()
+
+# Bound how many regex candidates one message may send to Nominatim
+MAX_GEOCODE_CANDIDATES = 4
+
+def classification_cache_key(city: Optional[str], country: Optional[str]) -> str:
+    """Normalized (city, country) key shared by every classification cache tier"""
+    return f"{normalize_location_query(city or '')}|{normalize_location_query(country or '')}"
+
+class SemanticClassificationIndex:
+    """Embeddings of cached display names, so near-identical places share a classification"""
+
+    def __init__(self, store: diskcache.Cache, embed_function):
+        self.store = store  # classification key -> float16 vector bytes
+        self.embed_function = embed_function  # text -> normalized vector or None
+        self._lock = threading.Lock()
+        self._keys = []
+        vectors = []
+        for key in self.store:
+            data = self.store.get(key)
+            if data is not None:
+                self._keys.append(key)
+                vectors.append(np.frombuffer(data, dtype=np.float16))
+        self._matrix = np.vstack(vectors).astype(np.float32) if vectors else None
+
+    def _embed(self, text: str):
+        try:
+            vector = self.embed_function(text)
+        except Exception as e:
+            logger.warning("Location embedding error: %s", e)
+            return None
+        return None if vector is None else np.asarray(vector, dtype=np.float32)
+
+    def lookup(self, text: str) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        """Return the key of the most similar cached location above the threshold, and the query vector"""
+        query = self._embed(text) if text else None
+        with self._lock:
+            matrix, keys = self._matrix, self._keys
+        if query is None or matrix is None or query.shape[0] != matrix.shape[1]:
+            return None, query
+        scores = matrix @ query
+        best = int(scores.argmax())
+        return (keys[best] if scores[best] >= SEMANTIC_MATCH_THRESHOLD else None), query
+
+    def add(self, key: str, vector: Optional[np.ndarray]):
+        """Index a classification key under the vector returned by lookup"""
+        if vector is None:
+            return
+        self.store.set(key, vector.astype(np.float16).tobytes(), expire=CLASSIFICATION_CACHE_TTL)
+        with self._lock:
+            row = vector[np.newaxis, :]
+            if self._matrix is None:
+                self._matrix = row
+            elif self._matrix.shape[1] == row.shape[1]:
+                self._matrix = np.vstack([self._matrix, row])
+            else:
+                return
+            self._keys = self._keys + [key]
+
+_JSON_DECODER = json.JSONDecoder()
+
+def _extract_json(text: str, open_char: str = '{'):
+    """Decode the first JSON object/array in text, or None if there is none"""
+    start = text.find(open_char)
+    if start < 0:
+        return None
+    # raw_decode stops at the end of the value, ignoring any trailing prose
+    return _JSON_DECODER.raw_decode(text, start)[0]
+
+class ClassificationBatcher:
+    """Micro-batches concurrent location classifications into a single LLM call"""
+
+    def __init__(self, classify_batch, window: float = CLASSIFICATION_BATCH_WINDOW,
+                 max_batch: int = MAX_CLASSIFICATION_BATCH):
+        self.classify_batch = classify_batch  # list of location infos -> list of classifications
+        self.window = window
+        self.max_batch = max_batch
+        self._cond = threading.Condition()
+        self._pending = []  # (key, location_info, future) waiting for the next flush
+        self._in_flight = {}  # key -> Future shared by concurrent requests for the same place
+        self._worker = None
+        self._executor = ThreadPoolExecutor(max_workers=4)
+
+    def submit(self, key: str, location_info: Dict) -> Future:
+        """Queue a classification, joining an in-flight request for the same key"""
+        with self._cond:
+            future = self._in_flight.get(key)
+            if future is not None:
+                return future
+            future = Future()
+            self._in_flight[key] = future
+            self._pending.append((key, location_info, future))
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+            self._cond.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            # Give concurrent requests a moment to join this batch
+            time.sleep(self.window)
+            with self._cond:
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+            self._executor.submit(self._flush, batch)
+
+    def _flush(self, batch):
+        try:
+            results = self.classify_batch([location_info for _, location_info, _ in batch])
+            error = None
+        except Exception as e:
+            results, error = [], e
+        with self._cond:
+            for key, _, _ in batch:
+                self._in_flight.pop(key, None)
+        for i, (_, _, future) in enumerate(batch):
+            if error is not None:
+                future.set_exception(error)
+            elif i < len(results) and results[i] is not None:
+                future.set_result(results[i])
+            else:
+                future.set_exception(ValueError("Missing classification in batch response"))
 
 class LocationBasedFashionAssistant:
     """Enhanced fashion assistant with LLM-powered location classification"""
     
-    def __init__(self, llm_chat_function):
+    def __init__(self, llm_chat_function, embed_function=None, cache_dir: str = LOCATION_CACHE_DIR):
         self.location_api = LocationAPI() 
-        self.location_cache = {}  # Cache location data to avoid repeated API calls
-        self.classification_cache = {}  # Cache LLM classifications
+        # Persistent caches so a restart does not re-pay geocoding and LLM calls
+        self.location_cache = diskcache.Cache(os.path.join(cache_dir, 'locations'))
+        self.classification_cache = diskcache.Cache(os.path.join(cache_dir, 'classifications'))
+        self.semantic_index = None
+        if embed_function is not None:
+            self.semantic_index = SemanticClassificationIndex(
+                diskcache.Cache(os.path.join(cache_dir, 'vectors')), embed_function)
+        self.batcher = ClassificationBatcher(self._classify_locations)
         self.llm_chat = llm_chat_function  # Your _llm_chat function
         
     def get_enhanced_location_info(self, location: str) -> Optional[Dict]:
         """Get detailed location information with LLM-powered classification"""
-        if location in self.location_cache:
-            return self.location_cache[location]
+        cache_key = normalize_location_query(location)
+        cached = self.location_cache.get(cache_key)
+        if cached is not None:
+            return cached
             
         polygon_data = self.location_api.get_user_location_polygon(location)
         
         if polygon_data:
             # Extract basic info from polygon data
             display_name = polygon_data.get('display_name', '')
-            address_details = polygon_data.get('address_details', {})
+            address_details = polygon_data.get('address') or {}
             
             # Get basic location components
             location_info = {
@@ -38,108 +438,127 @@ class LocationBasedFashionAssistant:
             }
             
             # Use LLM to classify location and get fashion market data
-            llm_classification = self._get_llm_location_classification(location_info)
+            llm_classification, cacheable = self._get_llm_location_classification(location_info)
             location_info.update(llm_classification)
+            self._with_joined_fields(location_info)
             
-            self.location_cache[location] = location_info
+            # Stand-in classifications serve this reply only, so the next request retries the LLM
+            if cacheable:
+                self.location_cache.set(cache_key, location_info, expire=LOCATION_CACHE_TTL)
             return location_info
             
         return None
     
-    def _get_llm_location_classification(self, location_info: Dict) -> Dict:
-        """Use LLM to classify location and get comprehensive fashion market data"""
-        
-        location_key = f"{location_info.get('city', '')}-{location_info.get('country', '')}"
-        
-        # Check cache first
-        if location_key in self.classification_cache:
-            return self.classification_cache[location_key]
+    def _get_llm_location_classification(self, location_info: Dict) -> Tuple[Dict, bool]:
+        """Use LLM to classify location; returns (classification, whether it may be cached)"""
         
+        location_key = classification_cache_key(location_info.get('city'), location_info.get('country'))
         display_name = location_info.get('display_name', '')
-        city = location_info.get('city', 'Unknown')
-        country = location_info.get('country', 'Unknown')
+        if location_key == '|':
+            # No city or country from the geocoder: key on the full place name instead
+            place_name = normalize_location_query(display_name)
+            if not place_name:
+                return self._classify_uncached(location_info), False
+            location_key = f"@{place_name}"
         
-        prompt = f"""
-        You are a global fashion market expert. Analyze this location and provide comprehensive fashion market information:
-        
-        Location: {display_name}
-        City: {city}
-        Country: {country}
-        
-        Provide information in this exact JSON format:
-        {{
-            "region": "geographical region (e.g., south_asia, europe, north_america, southeast_asia, middle_east, africa, oceania)",
-            "climate_zone": "climate type (tropical, subtropical, temperate, arid, continental, oceanic, mountain)",
-            "fashion_market": "market classification (indian, american, european, british, japanese, etc.)",
-            "local_brands": ["list of 6-8 popular local fashion brands actually available in this location"],
-            "available_stores": ["list of 6-8 popular stores/retailers in this location"],
-            "online_platforms": ["list of popular online shopping platforms for this region"],
-            "cultural_considerations": ["list of 3-5 cultural factors affecting fashion choices"],
-            "seasonal_info": "brief description of seasonal fashion needs and weather patterns",
-            "price_range_info": "typical price ranges and currency information",
-            "popular_styles": ["list of 4-6 popular fashion styles in this region"],
-            "climate_recommendations": {{
-                "fabrics": ["recommended fabric types for this climate"],
-                "colors": ["suitable color palettes"],
-                "styles": ["appropriate clothing styles"],
-                "essentials": ["weather-essential items"]
-            }}
-        }}
-        
-        Be accurate and specific. Only include brands/stores that are actually available in this location.
-        Consider the local climate, culture, economy, and fashion preferences.
-        """
+        # Check cache first: exact key, then a semantically equivalent place
+        cached = self.classification_cache.get(location_key)
+        if cached is not None:
+            return cached, True
+        query_vector = None
+        if self.semantic_index is not None:
+            similar_key, query_vector = self.semantic_index.lookup(display_name)
+            cached = self.classification_cache.get(similar_key) if similar_key else None
+            if cached is not None:
+                return cached, True
         
         try:
-            response = self.llm_chat(prompt, task_complexity='complex')
-            
-            # Parse JSON response
-            classification = self._parse_llm_classification_response(response)
+            classification = self.batcher.submit(location_key, location_info).result()
             
             # Cache the result
-            self.classification_cache[location_key] = classification
+            self.classification_cache.set(location_key, classification, expire=CLASSIFICATION_CACHE_TTL)
+            if self.semantic_index is not None:
+                self.semantic_index.add(location_key, query_vector)
             
-            return classification
+            return classification, True
             
+        except TextClassification as e:
+            return e.classification, False
+        except Exception as e:
+            logger.warning("LLM location classification error: %s", e)
+            return self._get_basic_fallback_classification(location_info), False
+    
+    def _classify_uncached(self, location_info: Dict) -> Dict:
+        """Classify a location that has no usable cache key, without caching the result"""
+        try:
+            return self._classify_locations([location_info])[0]
+        except TextClassification as e:
+            return e.classification
         except Exception as e:
-            print(f"LLM location classification error: {e}")
+            logger.warning("LLM location classification error: %s", e)
             return self._get_basic_fallback_classification(location_info)
     
+    def _classification_prompt(self, location_info: Dict) -> str:
+        return _CLASSIFICATION_PROMPT_PREFIX + _CLASSIFICATION_PROMPT_TAIL.format_map({
+            'display_name': location_info.get('display_name', ''),
+            'city': location_info.get('city', 'Unknown'),
+            'country': location_info.get('country', 'Unknown'),
+        })
+    
+    def _batch_classification_prompt(self, location_infos: List[Dict]) -> str:
+        locations = '\n'.join(
+            _BATCH_LOCATION_LINE.format(
+                index=i,
+                display_name=info.get('display_name', ''),
+                city=info.get('city', 'Unknown'),
+                country=info.get('country', 'Unknown'),
+            )
+            for i, info in enumerate(location_infos, 1)
+        )
+        return _BATCH_CLASSIFICATION_PROMPT_PREFIX + locations
+    
+    def _classify_locations(self, location_infos: List[Dict]) -> List[Optional[Dict]]:
+        """Classify a batch of locations with one LLM call"""
+        if len(location_infos) == 1:
+            response = self._chat_structured(self._classification_prompt(location_infos[0]))
+            return [self._parse_llm_classification_response(response)]
+        response = self._chat_structured(self._batch_classification_prompt(location_infos))
+        return self._parse_llm_classification_list(response)
+    
+    def _chat_structured(self, prompt: str) -> str:
+        response = self.llm_chat(prompt, task_complexity='structured_json')
+        # _llm_chat reports failure with a canned reply; raise so it is never parsed or cached
+        if response == LLM_ERROR_REPLY:
+            raise RuntimeError("LLM unavailable for location classification")
+        return response
+    
     def _parse_llm_classification_response(self, response: str) -> Dict:
         """Parse LLM response into classification data"""
         try:
             # Try to extract JSON from response
-            json_match = re.search(r'\{.*\}', response, re.DOTALL)
-            if json_match:
-                json_str = json_match.group()
-                classification = json.loads(json_str)
-                
-                # Validate required fields
-                required_fields = ['region', 'climate_zone', 'fashion_market']
-                for field in required_fields:
-                    if field not in classification:
-                        classification[field] = 'unknown'
-                
-                # Ensure lists exist
-                list_fields = ['local_brands', 'available_stores', 'online_platforms', 'cultural_considerations', 'popular_styles']
-                for field in list_fields:
-                    if field not in classification or not isinstance(classification[field], list):
-                        classification[field] = []
-                
-                # Ensure climate_recommendations exists
-                if 'climate_recommendations' not in classification:
-                    classification['climate_recommendations'] = {
-                        'fabrics': [], 'colors': [], 'styles': [], 'essentials': []
-                    }
-                
-                return classification
-            else:
-                # Try to parse as text if JSON extraction fails
-                return self._parse_text_classification_response(response)
+            data = _extract_json(response)
+            if data is not None:
+                return _normalize_classification(data)
                 
         except json.JSONDecodeError as e:
-            print(f"JSON parsing error: {e}")
-            return self._parse_text_classification_response(response)
+            logger.warning("JSON parsing error: %s", e)
+        
+        # Try to parse as text if JSON extraction fails
+        raise TextClassification(self._parse_text_classification_response(response))
+    
+    def _parse_llm_classification_list(self, response: str) -> List[Optional[Dict]]:
+        """Parse a batched LLM response into one classification per location"""
+        items = _extract_json(response, '[')
+        if items is None:
+            raise ValueError("No JSON array in batch classification response")
+        classifications = []
+        for item in items:
+            try:
+                classifications.append(_normalize_classification(item))
+            except (ValueError, fastjsonschema.JsonSchemaException) as e:
+                logger.warning("Classification schema error: %s", e)
+                classifications.append(None)
+        return classifications
     
     def _parse_text_classification_response(self, response: str) -> Dict:
         """Parse non-JSON LLM response as fallback"""
@@ -167,8 +586,8 @@ class LocationBasedFashionAssistant:
             line = line.strip()
             if ':' in line and not line.startswith('-'):
                 parts = line.split(':', 1)
-                key = parts[0].strip().lower().replace(' ', '_').replace('-', '_')
-                value = parts[1].strip()
+                key = parts[0].strip().strip('"').lower().replace(' ', '_').replace('-', '_')
+                value = parts[1].strip().rstrip(',')
                 
                 if key in ['region', 'climate_zone', 'fashion_market', 'seasonal_info', 'price_range_info']:
                     classification[key] = value.strip('"')
@@ -184,40 +603,18 @@ class LocationBasedFashionAssistant:
     
     def _get_basic_fallback_classification(self, location_info: Dict) -> Dict:
         """Basic fallback classification if LLM fails completely"""
-        country = location_info.get('country', '').lower()
+        country = (location_info.get('country') or '').strip().lower()
         
         # Simple country-based fallbacks
-        fallback_data = {
-            'region': 'unknown',
-            'climate_zone': 'temperate',
-            'fashion_market': 'international',
-            'local_brands': ['Zara', 'H&M', 'Uniqlo'],
-            'available_stores': ['Local malls', 'Online retailers'],
-            'online_platforms': ['Amazon', 'Local e-commerce'],
-            'cultural_considerations': ['Weather appropriate', 'Occasion suitable'],
-            'seasonal_info': 'Four seasons with varying temperatures',
-            'price_range_info': 'Mid-range pricing',
-            'popular_styles': ['Casual', 'Smart casual', 'Formal'],
-            'climate_recommendations': {
-                'fabrics': ['Cotton', 'Polyester blends'],
-                'colors': ['Neutral tones', 'Seasonal colors'],
-                'styles': ['Layerable pieces', 'Versatile basics'],
-                'essentials': ['Jacket', 'Comfortable shoes']
-            }
-        }
-        
-        # Basic region detection
-        if any(term in country for term in ['india', 'pakistan', 'bangladesh', 'sri lanka']):
-            fallback_data['region'] = 'south_asia'
-            fallback_data['climate_zone'] = 'tropical'
-        elif any(term in country for term in ['united states', 'usa', 'canada']):
-            fallback_data['region'] = 'north_america'
-        elif any(term in country for term in ['united kingdom', 'france', 'germany', 'spain', 'italy']):
-            fallback_data['region'] = 'europe'
-        
-        return fallback_data
+        region = _COUNTRY_TO_REGION.get(country, 'unknown')
+        return dict(
+            _FALLBACK_DATA,
+            region=region,
+            climate_zone=_REGION_CLIMATE.get(region, 'temperate'),
+            climate_recommendations=dict(_FALLBACK_DATA['climate_recommendations']),
+        )
     
-    def get_climate_appropriate_recommendations(self, location_info: Dict, season: str = None) -> Dict:
+    def get_climate_appropriate_recommendations(self, location_info: Dict, season: str = None) -> Mapping:
         """Get clothing recommendations based on LLM-analyzed climate data"""
         climate_recs = location_info.get('climate_recommendations', {})
         
@@ -228,109 +625,120 @@ class LocationBasedFashionAssistant:
         # Fallback to basic climate-based recommendations
         climate_zone = location_info.get('climate_zone', 'temperate')
         
-        fallback_recs = {
-            'tropical': {
-                'fabrics': ['cotton', 'linen', 'breathable synthetics', 'modal'],
-                'colors': ['light colors', 'pastels', 'whites', 'bright colors'],
-                'styles': ['loose fitting', 'sleeveless', 'midi dresses', 'palazzo pants'],
-                'essentials': ['sun hat', 'sunglasses', 'light scarf', 'comfortable sandals']
-            },
-            'arid': {
-                'fabrics': ['cotton', 'linen', 'lightweight wool'],
-                'colors': ['earth tones', 'light colors', 'avoid dark colors'],
-                'styles': ['full coverage', 'loose fitting', 'long sleeves'],
-                'essentials': ['wide-brimmed hat', 'sunglasses', 'scarf', 'closed shoes']
-            },
-            'temperate': {
-                'fabrics': ['cotton', 'wool blends', 'denim', 'knits'],
-                'colors': ['versatile neutrals', 'seasonal colors'],
-                'styles': ['layerable pieces', 'versatile basics'],
-                'essentials': ['light jacket', 'comfortable shoes', 'scarf']
-            }
-        }
-        
-        return fallback_recs.get(climate_zone, fallback_recs['temperate'])
+        return _FALLBACK_CLIMATE_RECS.get(climate_zone, _FALLBACK_CLIMATE_RECS['temperate'])
+    
+    def _with_joined_fields(self, location_info: Dict) -> Dict:
+        """Join the prompt's list fields once so cached locations reuse the strings"""
+        for key in _ENHANCED_PROMPT_LIST_FIELDS:
+            location_info[key + '_str'] = ', '.join(location_info.get(key, ()))
+        climate_recs = self.get_climate_appropriate_recommendations(location_info)
+        for key in _CLIMATE_REC_FIELDS:
+            location_info['climate_' + key + '_str'] = ', '.join(climate_recs.get(key, ()))
+        return location_info
     
     def generate_location_enhanced_prompt(self, user_message: str, location_info: Dict) -> str:
         """Generate enhanced prompt with LLM-analyzed location information"""
         
-        climate_recs = self.get_climate_appropriate_recommendations(location_info)
-        
-        enhanced_prompt = f"""
-        You are Cultura, a location-aware fashion expert with access to comprehensive location data:
-        
-        LOCATION DETAILS:
-        - City: {location_info.get('city', 'Unknown')}
-        - State/Region: {location_info.get('state', 'Unknown')}
-        - Country: {location_info.get('country', 'Unknown')}
-        - Region: {location_info.get('region', 'unknown')}
-        - Climate Zone: {location_info.get('climate_zone', 'temperate')}
-        - Fashion Market: {location_info.get('fashion_market', 'international')}
-        
-        LOCAL FASHION ECOSYSTEM:
-        - Available Local Brands: {', '.join(location_info.get('local_brands', []))}
-        - Popular Stores: {', '.join(location_info.get('available_stores', []))}
-        - Online Platforms: {', '.join(location_info.get('online_platforms', []))}
-        - Price Range: {location_info.get('price_range_info', 'Varies')}
-        
-        CULTURAL & CLIMATE CONTEXT:
-        - Cultural Considerations: {', '.join(location_info.get('cultural_considerations', []))}
-        - Popular Local Styles: {', '.join(location_info.get('popular_styles', []))}
-        - Seasonal Info: {location_info.get('seasonal_info', 'Varies by season')}
-        
-        CLIMATE-APPROPRIATE RECOMMENDATIONS:
-        - Recommended Fabrics: {', '.join(climate_recs.get('fabrics', []))}
-        - Suitable Colors: {', '.join(climate_recs.get('colors', []))}
-        - Style Suggestions: {', '.join(climate_recs.get('styles', []))}
-        - Weather Essentials: {', '.join(climate_recs.get('essentials', []))}
-        
-        USER MESSAGE: "{user_message}"
-        
-        INSTRUCTIONS:
-        1. Provide fashion advice using SPECIFIC brands and stores from the local ecosystem above
-        2. Consider the climate zone and cultural factors for appropriateness
-        3. Include specific product recommendations with styling tips
-        4. Mention where they can shop (specific stores/online platforms)
-        5. Consider the local price range and popular styles
-        6. Give 3-5 concrete, actionable recommendations
+        # Entries cached before the joined fields existed are joined on the fly
+        if 'local_brands_str' not in location_info:
+            location_info = self._with_joined_fields(dict(location_info))
         
-        Keep response under 300 words. Be enthusiastic and specific. Use occasional emojis. No markdown formatting.
-        """
+        fields = {key: location_info.get(key, default) for key, default in _ENHANCED_PROMPT_DEFAULTS.items()}
+        for key in _ENHANCED_PROMPT_LIST_FIELDS:
+            fields[key] = location_info[key + '_str']
+        for key in _CLIMATE_REC_FIELDS:
+            fields[key] = location_info['climate_' + key + '_str']
+        fields['user_message'] = user_message
         
-        return enhanced_prompt
+        return _ENHANCED_PROMPT_PREFIX + _ENHANCED_PROMPT_TAIL.format_map(fields)
 
 # Integration functions
+def get_location_assistant(llm_chat_function) -> LocationBasedFashionAssistant:
+    """Return the shared assistant so its caches and HTTP session persist across requests"""
+    global _ASSISTANT_SINGLETON
+    assistant = _ASSISTANT_SINGLETON
+    # == rather than `is`: each attribute access creates a new bound-method object
+    if assistant is None or assistant.llm_chat != llm_chat_function:
+        with _ASSISTANT_LOCK:
+            assistant = _ASSISTANT_SINGLETON
+            if assistant is None or assistant.llm_chat != llm_chat_function:
+                assistant = LocationBasedFashionAssistant(llm_chat_function, embed_function=embed_message)
+                _ASSISTANT_SINGLETON = assistant
+    return assistant
+
+def _location_candidates(message: str) -> List[str]:
+    """Return location candidates from every pattern, in pattern priority order"""
+    return [match for pattern in _LOCATION_PATTERNS for match in pattern.findall(message)]
+
+def _is_location_mention(message: str, text: str, start: int) -> bool:
+    """Accept a gazetteer hit only where it reads as a place, not a common word
+    ("nice", "reading", "split" are all cities)"""
+    if _LOCATION_PREPOSITION_RE.search(text, 0, start):
+        return True
+    # Capitalisation only counts mid-sentence; offsets line up unless lower() changed the length
+    if len(text) != len(message) or not message[start].isupper():
+        return False
+    before = text[:start].rstrip()
+    return bool(before) and before[-1] not in '.!?'
+
+def _gazetteer_match(message: str) -> Optional[str]:
+    """Return the longest whole-word gazetteer city in the message, in one linear pass"""
+    text = message.lower()
+    best = None
+    for end, (length, name) in _GAZETTEER.iter(text):
+        start = end - length + 1
+        if start > 0 and text[start - 1].isalnum():
+            continue
+        if end + 1 < len(text) and text[end + 1].isalnum():
+            continue
+        if best is not None and length <= best[0]:
+            continue
+        if _is_location_mention(message, text, start):
+            best = (length, name)
+    return best[1] if best else None
+
 def enhanced_location_extract(message: str, user_id: str, llm_chat_function) -> Optional[Dict]:
     """Enhanced location extraction with LLM classification"""
-    assistant = LocationBasedFashionAssistant(llm_chat_function)
+    return _extract_location(message, llm_chat_function)[1]
+
+def _extract_location(message: str, llm_chat_function):
+    """Return (assistant, location_info) so callers can keep using the same assistant"""
+    # A known city from the gazetteer avoids geocoding regex false positives
+    if _GAZETTEER is not None:
+        location = _gazetteer_match(message)
+        candidates = [location] if location else []
+    else:
+        # Look for location patterns in the message
+        candidates = []
+        for match in _location_candidates(message):
+            location = match.strip()
+            if len(location) > 2 and location.lower() not in _LOCATION_STOPWORDS and location not in candidates:
+                candidates.append(location)
+        candidates = candidates[:MAX_GEOCODE_CANDIDATES]
     
-    # Look for location patterns in the message
-    location_patterns = [
-        r"(?:from|in|at|live in|based in|located in)\s+([A-Z][a-zA-Z\s,]+)",
-        r"([A-Z][a-zA-Z\s]+,\s*[A-Z][a-zA-Z\s]+)",  # City, Country
-        r"\b([A-Z][a-zA-Z]+(?:\s+[A-Z][a-zA-Z]+)*)\b(?=\s+(?:city|area|region))",
-        r"I'm in ([A-Z][a-zA-Z\s,]+)"
-    ]
+    # Most chats mention no place, so skip the assistant entirely
+    if not candidates:
+        return None, None
+    assistant = get_location_assistant(llm_chat_function)
     
-    for pattern in location_patterns:
-        matches = re.findall(pattern, message, re.IGNORECASE)
-        for match in matches:
-            location = match.strip()
-            if len(location) > 2 and location.lower() not in ['the', 'and', 'for', 'with']:
-                location_info = assistant.get_enhanced_location_info(location)
-                if location_info:
-                    return location_info
+    # Geocode one candidate at a time in priority order: Nominatim's usage policy
+    # allows at most one request per second, and the geo cache absorbs repeats
+    for location in candidates:
+        location_info = assistant.get_enhanced_location_info(location)
+        if location_info:
+            return assistant, location_info
     
-    return None
+    return assistant, None
 
 def generate_enhanced_fashion_response(message: str, intent_category: str, user_id: str, llm_chat_function) -> str:
     """Enhanced fashion response with LLM-powered location analysis"""
     
+    # Runs sequentially on purpose: classification needs the geocoded city/country
+    # and the reply prompt needs the classification, so no two calls are independent
     # Get enhanced location information
-    location_info = enhanced_location_extract(message, user_id, llm_chat_function)
+    assistant, location_info = _extract_location(message, llm_chat_function)
     
     if location_info:
-        assistant = LocationBasedFashionAssistant(llm_chat_function)
         enhanced_prompt = assistant.generate_location_enhanced_prompt(message, location_info)
         
         # Use the LLM function to generate response
@@ -358,6 +766,8 @@ def test_llm_location_enhanced_fashion(llm_chat_function):
         print("-" * 50)
 
 if __name__ == "__main__":
+    configure_logging()
+    
     # Mock LLM function for testing
     def mock_llm_chat(prompt, task_complexity='medium'):
         return '{"region": "south_asia", "climate_zone": "tropical", "local_brands": ["Fabindia", "Myntra", "Ajio"], "fashion_market": "indian"}'
@@ -1,11 +1,34 @@
 import os
+import time
+import asyncio
+import httpx
 from dotenv import load_dotenv
 load_dotenv()
 from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters
-from gemini_utils import handle_telegram_message
+from gemini_utils import stream_user_message_async, format_response, set_location_http_client
 
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+# Cap in-flight replies so concurrent chats stay within LLM rate limits
+MAX_CONCURRENT_REPLIES = 32
+_reply_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REPLIES)
+# Streamed replies edit the placeholder once ~40 new tokens arrive, at most once a second
+# (Telegram rate-limits message edits)
+STREAM_EDIT_MIN_CHARS = 200
+STREAM_EDIT_INTERVAL = 1.0
+EMPTY_REPLY = "Sorry, I couldn't come up with a reply. Please try again! 😊"
+
+async def post_init(application):
+    """Open one keep-alive HTTP/2 client for geocoding that lives as long as the bot"""
+    client = httpx.AsyncClient(http2=True, limits=httpx.Limits(max_keepalive_connections=32))
+    application.bot_data['http'] = client
+    set_location_http_client(client)
+
+async def post_shutdown(application):
+    client = application.bot_data.pop('http', None)
+    if client is not None:
+        set_location_http_client(None)
+        await client.aclose()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
@@ -15,17 +38,45 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_msg = update.message.text
     user_id = str(update.message.from_user.id)
+    message = await update.message.reply_text("…")
+    text = ''
+    sent = ''
+    sent_len = 0
+    last_edit = time.monotonic()
     try:
-        reply = handle_telegram_message(user_msg, user_id)
+        async with _reply_semaphore:
+            async for chunk in stream_user_message_async(user_msg, user_id):
+                text += chunk
+                now = time.monotonic()
+                if len(text) - sent_len >= STREAM_EDIT_MIN_CHARS and now - last_edit >= STREAM_EDIT_INTERVAL:
+                    partial = format_response(text)
+                    try:
+                        await message.edit_text(partial)
+                        sent = partial
+                    except Exception as e:
+                        print(f"Telegram edit error: {e}")
+                    sent_len, last_edit = len(text), now
+        reply = format_response(text) or EMPTY_REPLY
     except Exception as e:
         reply = f"Sorry, there was an error: {e}"
-    await update.message.reply_text(reply)
+    if reply != sent:
+        try:
+            await message.edit_text(reply)
+        except Exception as e:
+            print(f"Telegram edit error: {e}")
 
 if __name__ == '__main__':
     if not TELEGRAM_BOT_TOKEN:
         print("Error: TELEGRAM_BOT_TOKEN not set in .env")
         exit(1)
-    app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler('start', start))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     print("Cultura Telegram bot is running...")
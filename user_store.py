@@ -0,0 +1,102 @@
+import threading
+from typing import Dict, Optional
+
+import msgpack
+import redis
+
+from config import REDIS_URL
+
+# Stored preferences expire after a day of inactivity
+USER_PREFERENCES_TTL = 86400
+
+_redis_client = None
+_redis_lock = threading.Lock()
+
+def get_redis_client() -> Optional[redis.Redis]:
+    """Shared Redis client, or None when REDIS_URL is not configured"""
+    global _redis_client
+    if not REDIS_URL:
+        return None
+    if _redis_client is None:
+        with _redis_lock:
+            if _redis_client is None:
+                pool = redis.BlockingConnectionPool.from_url(REDIS_URL, max_connections=32)
+                _redis_client = redis.Redis(connection_pool=pool)
+    return _redis_client
+
+class UserPreferenceStore:
+    """Dict-like per-user preference store, shared across workers through Redis when configured"""
+
+    def __init__(self, client: Optional[redis.Redis] = None, ttl: int = USER_PREFERENCES_TTL):
+        self._client = client
+        self._ttl = ttl
+        self._local = {}  # Used when Redis is not configured
+
+    def _key(self, user_id: str) -> str:
+        # Hash layout; distinct from the old "user:" string keys so leftovers can't hit WRONGTYPE
+        return f"user_prefs:{user_id}"
+
+    @staticmethod
+    def _pack(fields: Dict) -> Dict:
+        return {key: msgpack.packb(value) for key, value in fields.items()}
+
+    @staticmethod
+    def _unpack(fields: Dict) -> Dict:
+        return {key.decode(): msgpack.unpackb(value) for key, value in fields.items()}
+
+    def get(self, user_id: str, default: Optional[Dict] = None) -> Optional[Dict]:
+        if self._client is None:
+            return self._local.get(user_id, default)
+        try:
+            fields = self._client.hgetall(self._key(user_id))
+        except redis.RedisError as e:
+            print(f"Redis error: {e}")
+            return default
+        if not fields:
+            return default
+        return self._unpack(fields)
+
+    def __getitem__(self, user_id: str) -> Dict:
+        prefs = self.get(user_id)
+        if prefs is None:
+            raise KeyError(user_id)
+        return prefs
+
+    def __setitem__(self, user_id: str, prefs: Dict):
+        if self._client is None:
+            self._local[user_id] = prefs
+            return
+        key = self._key(user_id)
+        try:
+            pipe = self._client.pipeline(transaction=True)
+            pipe.delete(key)
+            if prefs:
+                pipe.hset(key, mapping=self._pack(prefs))
+                pipe.expire(key, self._ttl)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Redis error: {e}")
+
+    def update(self, user_id: str, fields: Dict) -> Optional[Dict]:
+        """Merge fields into the stored preferences with one HSET per field; returns None if Redis fails"""
+        if self._client is None:
+            prefs = self._local.setdefault(user_id, {})
+            prefs.update(fields)
+            return prefs
+        if not fields:
+            return self.get(user_id, {})
+        key = self._key(user_id)
+        try:
+            # Field-level writes leave concurrent updates to other fields intact
+            pipe = self._client.pipeline(transaction=True)
+            pipe.hset(key, mapping=self._pack(fields))
+            pipe.expire(key, self._ttl)
+            pipe.hgetall(key)
+            stored = pipe.execute()[-1]
+        except redis.RedisError as e:
+            print(f"Redis error, skipping preference update: {e}")
+            return None
+        return self._unpack(stored)
+
+    def __contains__(self, user_id: str) -> bool:
+        return self.get(user_id) is not None
@@ -0,0 +1,10 @@
+# Gevent must patch the standard library before anything else imports it
+from gevent import monkey
+monkey.patch_all()
+
+import os
+# gRPC does not cooperate with gevent, so send Gemini calls over REST (requests).
+# The web views only use the sync SDK methods, which support the REST transport.
+os.environ.setdefault('GEMINI_TRANSPORT', 'rest')
+
+from app import app